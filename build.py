@@ -2,15 +2,22 @@
 
 Build application executable for Win32 in a virtual environment
 and pack it with the INI file in a ZIP file for distribution.
+
+Built executables are cached, so the executable is only rebuilt when
+its sources change. Use the '--force' option to always rebuild it.
 """
 from collections.abc import Sequence
+from functools import cache
+from hashlib import blake2b
+from importlib.metadata import distributions
 from io import TextIOWrapper
 import os
-from pathlib import Path
-from subprocess import CalledProcessError, CompletedProcess, run
+import re
+from shutil import copy2, copyfileobj
+from subprocess import CalledProcessError, CompletedProcess, DEVNULL, PIPE, run
 import sys
 from typing import TextIO
-from zipfile import ZIP_DEFLATED, ZipFile
+from zipfile import ZIP_DEFLATED, ZIP_STORED, ZipFile, ZipInfo
 
 from sacamantecas import Constants
 from version import SEMVER
@@ -21,20 +28,41 @@ VENV_PATH = APP_PATH.parent / '.venv'
 BUILD_PATH = APP_PATH.parent / 'build'
 PYINSTALLER = VENV_PATH / 'Scripts' / 'pyinstaller.exe'
 FROZEN_EXE_PATH = (BUILD_PATH / APP_PATH.name).with_suffix('.exe')
+FROZEN_EXE_EXCLUDED_MODULES = ('tkinter', 'unittest', 'test', 'pydoc_data')
+FROZEN_EXE_CACHE_PATH = BUILD_PATH / 'cache'
+FROZEN_EXE_CACHE_SIZE = 5
+FORCE_REBUILD_OPTION = '--force'
 PACKAGE_PATH = APP_PATH.with_stem(f'{APP_PATH.stem}_v{SEMVER.split('+')[0]}').with_suffix('.zip')
 INIFILE_PATH = Constants.INIFILE_PATH
-REQUIREMENTS_FILE = Path('requirements.txt')
+REQUIREMENTS_FILE = APP_PATH.parent / 'requirements.txt'
 ERROR_MARKER = '\n*** '
 ERROR_HEADER = 'Error, '
 PROGRESS_MARKER = '  ▶ '
+PACKAGE_COMPRESSLEVEL = 6
+PACKAGE_COPY_BUFSIZE = 1 << 20
+REQUIREMENT_NAME_RE = re.compile(r'^[A-Za-z0-9][A-Za-z0-9._-]*')
+REQUIREMENTS_IGNORED_PREFIXES = ('#', '-')
+PACKAGE_NAME_SEPARATORS_RE = re.compile(r'[-_.]+')
 
 
 # Reconfigure standard output streams so they use UTF-8 encoding, no matter
 # if they are redirected to a file when running the program from a shell.
+# They are also line buffered, so every message is printed as soon as it is
+# complete without needing an explicit flush.
 if sys.stdout and isinstance(sys.stdout, TextIOWrapper):
-    sys.stdout.reconfigure(encoding=Constants.UTF8)
+    sys.stdout.reconfigure(encoding=Constants.UTF8, line_buffering=True)
 if sys.stderr and isinstance(sys.stderr, TextIOWrapper):
-    sys.stderr.reconfigure(encoding=Constants.UTF8)
+    sys.stderr.reconfigure(encoding=Constants.UTF8, line_buffering=True)
+
+
+@cache
+def get_marker_indent(marker: str) -> str:
+    """Get the indentation which aligns continuation lines with text after marker.
+
+    Only printable characters of marker are taken into account. Since just a few
+    different markers are used, the result is cached.
+    """
+    return ' ' * sum(map(str.isprintable, marker))
 
 
 def pretty_print(message: str, *, marker: str = '', header: str = '', stream: TextIO = sys.stdout) -> None:
@@ -44,18 +72,10 @@ def pretty_print(message: str, *, marker: str = '', header: str = '', stream: Te
     are indented according to the length of the marker so they are aligned with
     the header.
 
-    The stream is finally flushed to ensure the message is printed.
-
     By default, marker and header are empty and the stream is sys.stdout.
     """
-    marker_len = len([char for char in marker if char.isprintable()])
-
-    lines = message.splitlines() if message else ['']
-    lines[0] = f'{marker}{header}{lines[0]}'
-    lines[1:] = [f'\n{' ' * marker_len}{line}' for line in lines[1:]]
-    lines[-1] += '\n'
-    stream.writelines(lines)
-    stream.flush()
+    message = f'\n{get_marker_indent(marker)}'.join(message.splitlines())
+    stream.write(f'{marker}{header}{message}\n')
 
 
 def error(message: str) -> None:
@@ -68,12 +88,19 @@ def progress(message: str) -> None:
     pretty_print(message, marker=PROGRESS_MARKER)
 
 
-def run_command(command: Sequence[str]) -> CompletedProcess[str]:
-    """Run command, capturing the output."""
+def run_command(command: Sequence[str], *, capture_stdout: bool = True) -> CompletedProcess[bytes]:
+    """Run command, capturing the output.
+
+    If capture_stdout is False, the standard output of the command is discarded
+    instead, and only the standard error is captured.
+
+    The output is captured as bytes, so it is not decoded unless needed.
+    """
+    stdout = PIPE if capture_stdout else DEVNULL
     try:
-        return run(command, check=True, capture_output=True, encoding=UTF8, text=True)  # noqa: S603
+        return run(command, check=True, stdout=stdout, stderr=PIPE)  # noqa: S603
     except FileNotFoundError as exc:
-        raise CalledProcessError(0, command, None, f"Command '{command[0]}' not found.\n") from exc
+        raise CalledProcessError(0, command, None, f"Command '{command[0]}' not found.\n".encode(UTF8)) from exc
 
 
 def is_venv_ready() -> bool:
@@ -96,42 +123,92 @@ def is_venv_ready() -> bool:
     return True
 
 
-def are_required_packages_installed() -> bool:
-    """Check installed packages to ensure they fit requirements.txt contents."""
-    progress('Checking that required packages are installed')
+def normalize_package_name(name: str) -> str:
+    """Normalize package name so it can be compared, as per PEP 503."""
+    return PACKAGE_NAME_SEPARATORS_RE.sub('-', name).lower()
 
-    pip_list = ['pip', 'list', '--local', '--format=freeze', '--not-required', '--exclude=pip']
-    installed_packages = {package.split('==')[0] for package in run_command(pip_list).stdout.splitlines()}
 
-    with REQUIREMENTS_FILE.open(encoding='utf-8') as requirements:
-        required_packages = [line for line in requirements.readlines() if not line.startswith('#')]
-        required_packages = {package.split('>=')[0] for package in required_packages}
+def are_required_packages_installed() -> bool:
+    """Check installed packages to ensure they fit requirements.txt contents.
+
+    The installed packages are obtained from the running interpreter metadata,
+    which is way faster than running 'pip list' in a subprocess.
+    """
+    progress('Checking that required packages are installed')
 
-    if diff := required_packages - installed_packages:
-        diff = '\n'.join(diff)
-        error(f'missing packages:\n{diff}\n')
+    installed_packages = {normalize_package_name(dist.name) for dist in distributions() if dist.name}
+
+    with REQUIREMENTS_FILE.open(encoding=UTF8) as requirements:
+        # Comments and option lines like '-r other.txt' are not requirements.
+        required_packages = (line.strip() for line in requirements)
+        required_packages = (line for line in required_packages if not line.startswith(REQUIREMENTS_IGNORED_PREFIXES))
+        required_packages = (REQUIREMENT_NAME_RE.match(line) for line in required_packages)
+        missing_packages = [
+            match[0] for match in required_packages
+            if match and normalize_package_name(match[0]) not in installed_packages
+        ]
+
+    if missing_packages:
+        missing_packages = '\n'.join(missing_packages)
+        error(f'missing packages:\n{missing_packages}\n')
         return False
 
     return True
 
 
-def build_frozen_executable() -> bool:
-    """Build frozen executable."""
+def get_sources_digest() -> str:
+    """Get a digest of everything the frozen executable is built from.
+
+    That is, the Python sources, requirements.txt, the Python version and the
+    versions of all installed packages, which includes PyInstaller itself.
+    """
+    digest = blake2b()
+    for source in sorted(APP_PATH.parent.glob('*.py')):
+        digest.update(source.name.encode(UTF8))
+        digest.update(source.read_bytes())
+    digest.update(REQUIREMENTS_FILE.read_bytes())
+    digest.update(sys.version.encode(UTF8))
+    installed_packages = [
+        f'{normalize_package_name(dist.name)}=={dist.version}' for dist in distributions() if dist.name
+    ]
+    digest.update('\n'.join(sorted(installed_packages)).encode(UTF8))
+    return digest.hexdigest()
+
+
+def build_frozen_executable(*, force: bool = False) -> bool:
+    """Build frozen executable.
+
+    Built executables are cached by a digest of their sources, so PyInstaller
+    is not run again when nothing changed since a previous build, unless force
+    is True. Only the FROZEN_EXE_CACHE_SIZE most recently used executables are
+    kept.
+    """
     progress('Building frozen executable')
 
-    if FROZEN_EXE_PATH.exists():
-        FROZEN_EXE_PATH.unlink()
+    cached_exe_path = (FROZEN_EXE_CACHE_PATH / get_sources_digest()).with_suffix('.exe')
+    if not force and cached_exe_path.exists():
+        progress(f'Reusing cached frozen executable {cached_exe_path}')
+        copy2(cached_exe_path, FROZEN_EXE_PATH)
+        cached_exe_path.touch()
+        return True
 
     cmd = [str(PYINSTALLER)]
-    cmd.append('--log-level=WARN')
+    cmd.extend(['--log-level=WARN', '--noconfirm'])
     cmd.extend([f'--workpath={BUILD_PATH}', f'--specpath={BUILD_PATH}', f'--distpath={BUILD_PATH}'])
-    cmd.extend(['--onefile', str(APP_PATH)])
+    cmd.extend(f'--exclude-module={module}' for module in FROZEN_EXE_EXCLUDED_MODULES)
+    cmd.extend(['--onefile', '--noupx', str(APP_PATH)])
     try:
-        run_command(cmd)
+        run_command(cmd, capture_stdout=False)
     except CalledProcessError as exc:
-        error(f'could not create frozen executable.\n{exc.stderr}')
+        error(f'could not create frozen executable.\n{exc.stderr.decode(UTF8, errors='replace')}')
         return False
 
+    FROZEN_EXE_CACHE_PATH.mkdir(parents=True, exist_ok=True)
+    copy2(FROZEN_EXE_PATH, cached_exe_path)
+    cached_exe_paths = sorted(FROZEN_EXE_CACHE_PATH.glob('*.exe'), key=lambda path: path.stat().st_mtime, reverse=True)
+    for stale_exe_path in cached_exe_paths[FROZEN_EXE_CACHE_SIZE:]:
+        stale_exe_path.unlink()
+
     return True
 
 
@@ -139,15 +216,27 @@ def build_package() -> None:
     """Build distributable package."""
     progress(f'Building distributable package {PACKAGE_PATH}.')
 
-    with ZipFile(PACKAGE_PATH, 'w', compression=ZIP_DEFLATED, compresslevel=9) as bundle:
-        bundle.write(FROZEN_EXE_PATH, FROZEN_EXE_PATH.name)
+    with ZipFile(PACKAGE_PATH, 'w', compression=ZIP_DEFLATED, compresslevel=PACKAGE_COMPRESSLEVEL) as bundle:
+        # The frozen executable is already compressed by PyInstaller, so it is
+        # stored as is, because deflating it again is slow and useless. Since
+        # it is quite big, it is copied using a larger buffer than the default
+        # one used by ZipFile.write().
+        exe_info = ZipInfo.from_file(FROZEN_EXE_PATH, FROZEN_EXE_PATH.name)
+        exe_info.compress_type = ZIP_STORED
+        with FROZEN_EXE_PATH.open('rb') as source, bundle.open(exe_info, 'w') as target:
+            copyfileobj(source, target, PACKAGE_COPY_BUFSIZE)
         bundle.write(INIFILE_PATH, INIFILE_PATH.name)
 
 
-def main() -> int:
+def main(*args: str) -> int:
     """."""
     pretty_print(f'Building {APP_PATH.stem} {SEMVER}')
 
+    if unknown_args := [arg for arg in args if arg != FORCE_REBUILD_OPTION]:
+        unknown_args = '\n'.join(unknown_args)
+        error(f'unknown arguments:\n{unknown_args}\n')
+        return 1
+
     if not is_venv_ready():
         return 1
 
@@ -156,7 +245,7 @@ def main() -> int:
 
     # The virtual environment is guaranteed to work from this point on.
 
-    if not build_frozen_executable():
+    if not build_frozen_executable(force=FORCE_REBUILD_OPTION in args):
         return 1
     build_package()
 
@@ -167,6 +256,6 @@ def main() -> int:
 
 if __name__ == '__main__':
     try:
-        sys.exit(main())
+        sys.exit(main(*sys.argv[1:]))
     except KeyboardInterrupt:
         sys.exit(1)